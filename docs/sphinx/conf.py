@@ -12,8 +12,12 @@
 # type: ignore
 
 import os
+import re
 
-from pkg_resources import parse_version
+try:
+    from packaging.version import InvalidVersion, Version
+except ImportError:
+    InvalidVersion = Version = None
 
 try:
     from sdss_semaphore import __version__
@@ -29,9 +33,6 @@ on_rtd = os.environ.get('READTHEDOCS') == 'True'
 sphinx_template = 'sphinx-bootstrap'
 use_releases = 'no'
 
-if sphinx_template == 'sphinx-bootstrap':
-    import sphinx_bootstrap_theme
-
 
 # Importing matplotlib here with agg to prevent tkinter error in readthedocs
 # import matplotlib
@@ -46,7 +47,9 @@ if sphinx_template == 'sphinx-bootstrap':
 
 # Add any Sphinx extension module names here, as strings. They can be
 # extensions coming with Sphinx (named 'sphinx.ext.*') or your custom
-# ones.
+# ones. These are all parallel read/write safe, so the Makefile builds with
+# `-j auto`; any local extension added here must return
+# {'parallel_read_safe': True, 'parallel_write_safe': True} from its setup().
 extensions = ['sphinx.ext.autodoc', 'sphinx.ext.napoleon', 'sphinx.ext.autosummary',
               'sphinx.ext.todo', 'sphinx.ext.viewcode', 'sphinx.ext.mathjax',
               'sphinx.ext.intersphinx']
@@ -77,7 +80,16 @@ author = 'Andy Casey'
 # built documents.
 
 # The short X.Y version.
-version = parse_version(__version__).base_version
+version = None
+if Version is not None:
+    try:
+        version = Version(__version__).base_version
+    except InvalidVersion:
+        # A non-PEP 440 version like 'dev'.
+        pass
+if version is None:
+    match = re.match(r'\d+(\.\d+)*', __version__)
+    version = match.group(0) if match else __version__
 # The full version, including alpha/beta/rc tags.
 release = __version__
 
@@ -217,6 +229,11 @@ if sphinx_template == 'sphinx-bootstrap':
     }
 
     # Add any paths that contain custom themes here, relative to this directory.
+    try:
+        import sphinx_bootstrap_theme
+    except ImportError:
+        raise ImportError("sphinx_bootstrap_theme is required to build the docs with the "
+                          "'sphinx-bootstrap' template: pip install sdss_semaphore[docs]")
     html_theme_path = sphinx_bootstrap_theme.get_html_theme_path()
 
     html_logo = '_static/sdssv_logo_small.png'
@@ -1,10 +1,134 @@
 __version__ = "0.2.3"
 
+import os
+import pickle
+from sys import intern
+import tempfile
 import numpy as np
 import warnings
-from typing import Dict, Union, Tuple, Iterable, List, Optional, Tuple
-from pkg_resources import resource_filename
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Mapping, Union, Tuple, Iterable, List, Optional, Tuple
 
+from sdss_semaphore import _kernels
+
+
+# The version of the cached mapping format (how the CSV is read, and how each row is stored). Bump
+# this whenever either changes, so that caches written by an older version are rebuilt.
+_MAPPING_CACHE_VERSION = 1
+
+
+def _read_mapping(path: str) -> dict:
+    """
+    Read a flag mapping CSV file into a dictionary keyed by bit position.
+
+    The parsed mapping is cached in a pickle file next to the CSV, together with the cache format
+    version and the size and modification time of the CSV, and that is read instead for as long
+    as all of these still match. If the cache cannot be read (or does not match), it is rebuilt,
+    and if it cannot be written (e.g., a read-only install), then we just parse the CSV every time.
+
+    :param path:
+        The path of the mapping CSV file.
+    """
+    cache_path = f"{path}.pkl"
+    stat = os.stat(path)
+    source = (_MAPPING_CACHE_VERSION, stat.st_size, stat.st_mtime)
+    try:
+        with open(cache_path, "rb") as fp:
+            cached_source, cached = pickle.load(fp)
+        if cached_source == source and isinstance(cached, dict):
+            return cached
+    except Exception:
+        # A missing, truncated, or otherwise unreadable cache: fall back to parsing the CSV.
+        pass
+
+    # Intern the strings, so that values repeated across rows (e.g., mapper and program names) are
+    # stored once. The pickle keeps this sharing, because it writes each object only once.
+    rows = [{ _as_python(key): _as_python(value) for key, value in row.items() } for row in _read_csv_rows(path)]
+    mapping = { row["bit"]: row for row in rows }
+
+    # Write to a temporary file and rename it, so other processes never read a partial cache.
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return mapping
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump((source, mapping), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        # mkstemp creates the file readable only by us, but other users of a shared install should
+        # be able to read the cache too.
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    return mapping
+
+
+def _as_python(value):
+    """Return a numpy scalar (e.g., from the astropy reader) as a Python scalar, with strings interned."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, str):
+        # `intern` only accepts exact `str`, not subclasses like `numpy.str_`.
+        value = intern(str(value))
+    return value
+
+
+def _read_csv_rows(path: str) -> List[dict]:
+    """
+    Read a CSV file into a list of dictionaries, one per row.
+
+    This uses the fastest reader available: pyarrow, then pandas, then astropy.
+
+    :param path:
+        The path of the CSV file.
+    """
+    try:
+        from pyarrow import csv
+    except ImportError:
+        pass
+    else:
+        columns = csv.read_csv(path).to_pydict()
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    try:
+        import pandas as pd
+    except ImportError:
+        pass
+    else:
+        return pd.read_csv(path).to_dict(orient="records")
+
+    from astropy.table import Table
+    return [dict(zip(row.colnames, row)) for row in Table.read(path)]
+
+
+# Which of the 8 (little-endian) bits are set in each possible byte, and how many, for when
+# `np.bitwise_count` (numpy >= 2.0) is not available.
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder="little").astype(np.int64)
+_POPCOUNT_LUT = _BYTE_BITS.sum(axis=1).astype(np.uint8)
+
+
+@lru_cache(maxsize=None)
+def _bit_mask_table(n_bits: int, dtype) -> np.ndarray:
+    """Return a (read-only) lookup table of the mask for each bit offset in a column of `n_bits` bits of `dtype`."""
+    lut = np.array([1 << offset for offset in range(n_bits)], dtype=np.uint64).astype(dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+class _KeyedCache(dict):
+    """A dictionary that computes (and keeps) the value for a missing key with a given function."""
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, key):
+        value = self[key] = self.factory(key)
+        return value
 
 
 class cached_class_property:
@@ -13,16 +137,21 @@ class cached_class_property:
     property, which caches its results on the class(es) on which it
     operates.
 
-    From the Dicken's library
+    Each class keeps its own result in its `__dict__`, so a subclass computes
+    its own value instead of inheriting one cached on a parent.
+
+    Adapted from the Dicken's library
     """
-    class AliasConflict(ValueError):
-        pass
 
     def __init__(self, func):
         self.__func__ = func
-        self.__cache_name__ = '_{}_'.format(func.__name__.strip('_'))
-        if self.__cache_name__ == func.__name__:
-            raise self.AliasConflict(self.__cache_name__)
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.__cache_name__ = f"_cached_{func.__name__}"
+
+    def __set_name__(self, owner, name):
+        self.__name__ = name
+        self.__cache_name__ = f"_cached_{name}"
 
     def __get__(self, instance, cls=None):
         if cls is None:
@@ -40,35 +169,92 @@ class BaseFlags:
 
     """A base class for communicating with flags."""
 
-    def __init__(self, array: Optional[Union[np.ndarray, Iterable[Iterable[int]], Iterable[bytearray], Iterable['BaseFlags']]] = None) -> None:
+    # The data array, plus what is cached from it (see `_clear_caches`), the version that those caches
+    # are checked against, and the buffer the data array grows into.
+    __slots__ = ("array", "_columnar", "_boolean", "_version", "_buffer")
+
+    def __init__(self, array: Optional[Union[np.ndarray, Iterable[Iterable[int]], Iterable[bytearray], Iterable[str], Iterable['BaseFlags']]] = None) -> None:
+        """
+        :param array: [optional]
+            The flags for each item, as an (N, B) array, a list of bytearrays or hex strings, or a
+            list of other flags. An (N, B) array that is writeable, C-contiguous, and already of
+            the right dtype is used as the data array without a copy, so changes made to it with
+            `set_bit`, `clear_bit`, or `toggle_bit` also change the array that was given. Anything
+            else is copied.
+        """
         if array is None:
             # Assume single object flag.
             self.array = np.zeros((1, 0), dtype=self.dtype)
-        elif isinstance(array, (list, tuple)) and isinstance(array[0], bytearray):
+        elif isinstance(array, (list, tuple)) and isinstance(array[0], (bytearray, str)):
             # TODO: If the self.dtype is not uint8, then we might need to compute these initial offsets ourselves,
             #       because I think bytearray is natively uint8
             if self.dtype != np.uint8:
                 warnings.warn("Converting from list of bytearrays to integer array, but `dtype` is not uint8. Hold on to your butts.")
-            N, F = (len(array), max(len(item) for item in array))
-            self.array = np.zeros((N, F), dtype=self.dtype)
+            # Group the items by length, so that each group is joined and decoded with one call.
+            # Usually all items have the same length, and there is just one group.
+            rows_by_length = {}
             for i, item in enumerate(array):
-                self.array[i, :len(item)] = np.frombuffer(item, dtype=self.dtype)
+                rows_by_length.setdefault(len(item), []).append(i)
+            # Hex strings use two characters per byte.
+            is_hex = isinstance(array[0], str)
+            if is_hex and any(length % 2 for length in rows_by_length):
+                raise ValueError("Hex strings must have an even number of characters.")
+            # Each item holds whole elements of `dtype`, in its native byte order (as np.frombuffer would).
+            itemsize = np.dtype(self.dtype).itemsize
+            n_bytes = { length: length // (2 if is_hex else 1) for length in rows_by_length }
+            if any(n % itemsize for n in n_bytes.values()):
+                raise ValueError(f"Items must be a whole number of {itemsize}-byte elements of {np.dtype(self.dtype)}.")
+            N, F = (len(array), max(n_bytes.values()) // itemsize)
+            self._allocate(N, F)
+            for length, rows in rows_by_length.items():
+                if length > 0:
+                    if is_hex:
+                        joined = bytes.fromhex("".join([array[i] for i in rows]))
+                    else:
+                        joined = b"".join([array[i] for i in rows])
+                    B = n_bytes[length] // itemsize
+                    self.array[rows, :B] = np.frombuffer(joined, dtype=self.dtype).reshape((-1, B))
         elif len(array) > 0 and isinstance(array[0], BaseFlags):
-            # need to pad the array to the maximum size
-            N, F, si = (0, 0, 0)
-            for item in array:
-                n, f = item.array.shape
-                F = max(F, f)
-                N += n
-            self.array = np.zeros((N, F), dtype=self.dtype)
-            for item in array:
-                n, f = item.array.shape
-                self.array[si:si + n, :f] = item.array
-                si += n            
+            # need to pad the array to the maximum size, and then to the padded buffer width (see
+            # `_allocate`), so that everything is joined into the buffer with one concatenate.
+            N, F = (sum(len(item) for item in array), max(item.array.shape[1] for item in array))
+            W = self._padded_width(F)
+            buffer = np.empty((N, W), dtype=self.dtype)
+            parts = [
+                item.array if item.array.shape[1] == W
+                else np.pad(item.array, ((0, 0), (0, W - item.array.shape[1])))
+                for item in array
+            ]
+            np.concatenate(parts, out=buffer, casting="unsafe")
+            self.array = buffer[:, :F]
+            self._buffer = buffer
         else:
-            self.array = np.atleast_2d(array).astype(self.dtype)
+            # Only copy if we have to: a C-contiguous (N, B) array of the right dtype is used as is.
+            # Contiguous rows let bulk operations view the data array as 64-bit words (see
+            # `_words`). Read-only arrays (e.g., from np.frombuffer or a read-only memmap) are
+            # copied, so that the flags can still be changed.
+            array = np.ascontiguousarray(np.atleast_2d(array), dtype=self.dtype)
+            self.array = array if array.flags.writeable else array.copy()
         return None
 
+    @classmethod
+    def from_sparse_bits(cls, n_items: int, indices, bits) -> "BaseFlags":
+        """
+        Create flags for `n_items` items from arrays of (item index, bit position) pairs.
+
+        The data array is allocated once, with all bits set in a single pass (see `set_bits`).
+
+        :param n_items:
+            The number of items.
+
+        :param indices:
+            An array of item indices.
+
+        :param bits:
+            An array of zero-indexed bit positions to set, of the same length as `indices`.
+        """
+        return cls(np.zeros((n_items, 0), dtype=cls.dtype)).set_bits(indices, bits)
+
     @property
     def dtype(self):
         raise NotImplementedError(f"`dtype` must be defined in subclass")
@@ -78,20 +264,55 @@ class BaseFlags:
         raise NotImplementedError(f"`n_bits` must be defined in subclass")
 
     @cached_class_property
-    def mapping(self) -> dict:
-        """A dictionary containing bit positions as keys, and dictionaries of flag attributes as values."""
+    def mapping(self) -> Mapping[int, dict]:
+        """
+        A read-only dictionary containing bit positions as keys, and dictionaries of flag attributes as values.
+
+        It is read-only because the attribute indexes and masks are built from it once per class.
+        """
         
         # TODO: The format and content of the mapping file is TBD. Here we will just load the CSV we have.
-        #       Once we have finalized the format and content, move this import out and add dependency (fits/astropy).
-        path = resource_filename(__name__, f'etc/{self.MAPPING_BASENAME}')
-        from astropy.table import Table
-        
-        mapping = {}
-        for row in Table.read(path):
-            row_dict = dict(zip(row.colnames, row))
-            mapping[row_dict["bit"]] = row_dict
-        return mapping
+        #       Once we have finalized the format and content, settle on one reader and add it as a dependency.
+        path = os.path.join(os.path.dirname(__file__), "etc", self.MAPPING_BASENAME)
+        return MappingProxyType(_read_mapping(path))
             
+    @cached_class_property
+    def _attribute_index(self) -> Dict[str, dict]:
+        """An inverted index of the mapping, keyed by attribute key, then attribute value, with a list of bit positions."""
+        index = {}
+        for bit, attrs in self.mapping.items():
+            for key, value in attrs.items():
+                index.setdefault(key, {}).setdefault(value, []).append(bit)
+        return index
+
+    @cached_class_property
+    def _attribute_values(self) -> Dict[str, tuple]:
+        """The distinct values of each attribute key, in the order they first appear in the mapping."""
+        return _KeyedCache(lambda key: tuple(self._attribute_index[key]))
+
+    @cached_class_property
+    def _attribute_masks(self) -> Dict[str, dict]:
+        """
+        Like `_attribute_index`, but with the data array columns and combined bit masks (see `_group_bits`)
+        in place of each list of bit positions. The mapping is fixed, so these are only worked out once,
+        and only for the attribute keys that are actually queried.
+        """
+        return _KeyedCache(lambda key: {
+            value: self._group_bits(bits) for value, bits in self._attribute_index[key].items()
+        })
+
+    @cached_class_property
+    def _attribute_word_masks(self) -> Dict[str, dict]:
+        """Like `_attribute_masks`, but for the data array viewed as 64-bit words (see `_word_masks`)."""
+        return _KeyedCache(lambda key: {
+            value: self._group_bits(bits, 64, np.dtype("<u8")) for value, bits in self._attribute_index[key].items()
+        })
+
+    @property
+    def _bit_lut(self) -> np.ndarray:
+        """The mask for each bit offset within a data array column, in the data array dtype."""
+        return _bit_mask_table(self.n_bits, self.array.dtype)
+
     @property
     def bits_set(self) -> Iterable[Tuple[int]]:
         """
@@ -102,8 +323,7 @@ class BaseFlags:
             items, bits = np.where(flags.as_boolean_array())
             
         """
-        for row in self.as_boolean_array():
-            yield tuple(np.where(row)[0])
+        yield from map(tuple, self._bits_set_per_item())
 
     @property
     def flags_set(self) -> Iterable[Tuple[Dict]]:
@@ -112,12 +332,20 @@ class BaseFlags:
         
         This can be a hugely expensive query if you have large number of items (e.g., stars).
         """
-        for row in self.as_boolean_array():
-            yield tuple(self.mapping[bit] for bit in np.where(row)[0])
+        for bits in self._bits_set_per_item():
+            yield tuple(self.mapping[bit] for bit in bits)
+
+    def _bits_set_per_item(self) -> List[List[int]]:
+        """Return a list of the bits set for each item, from one pass over the boolean array."""
+        if len(self) == 0:
+            return []
+        items, bits = np.nonzero(self.as_boolean_array())
+        splits = np.searchsorted(items, np.arange(1, len(self)))
+        return [chunk.tolist() for chunk in np.split(bits, splits)]
         
     def _all_attributes(self, key):
         """Helper function to return unique set of attributes for all flags."""
-        return tuple(set(attrs[key] for attrs in self.mapping.values()))
+        return self._attribute_values[key]
 
     def count(self, skip_empty: bool = False) -> dict:
         """
@@ -126,11 +354,20 @@ class BaseFlags:
         :param skip_empty: [optional]
             Skip flags with no items assigned to them.
         """
-        return self._count(
-            { bit: [bit] for bit in self.mapping.keys() }, 
+        return self._count_bits(
+            { bit: bit for bit in self.mapping.keys() }, 
             skip_empty=skip_empty
         )
 
+    def popcount_per_item(self) -> np.ndarray:
+        """Return an N-length array of the number of bits set for each item."""
+        # Count 64 bits at a time where the data array can be viewed as words (see `_words`).
+        words = self._words()
+        array = self.array if words is None else words
+        if hasattr(np, "bitwise_count"):
+            return np.bitwise_count(array).sum(axis=1, dtype=np.int64)
+        return _POPCOUNT_LUT[np.ascontiguousarray(array).view(np.uint8)].sum(axis=1, dtype=np.int64)
+
     def count_by_attribute(self, attribute, skip_empty: bool = False) -> dict:
         """
         Return a dictionary of the items assigned with flags of a given attribute.
@@ -145,44 +382,211 @@ class BaseFlags:
         :param skip_empty: [optional]
             Skip flags with no items assigned to them.
         """    
-        # Need bits per attribute to avoid double-counting
-        bits_per_attribute = {}
-        for bit, attributes in self.mapping.items():
-            bits_per_attribute.setdefault(attributes[attribute], [])
-            bits_per_attribute[attributes[attribute]].append(bit)
-        return self._count(bits_per_attribute, skip_empty=skip_empty)
+        # Need bits per attribute to avoid double-counting: one masked OR over the packed data array
+        # for each value, using the column masks that are worked out once per class.
+        counts = {}
+        for value in self._attribute_index[attribute]:
+            count = int(np.count_nonzero(self.is_attribute_set(attribute, value)))
+            if count > 0 or not skip_empty:
+                counts[value] = count
+        return counts
 
-    def _count(self, bits_per_attribute, skip_empty: bool = False) -> dict:
+    def _count_bits(self, bit_per_key, skip_empty: bool = False) -> dict:
         """
-        Count the number of items assigned to flags with given attributes.
+        Count the number of items that have a single given bit set, for many bits at once.
+
+        The flags are never unpacked: the totals for all bits come at once from a histogram of the
+        byte values in each data array column (see `_bit_totals`), instead of one pass per bit.
+
+        :param bit_per_key:
+            A dictionary of the bit position to count for each key.
 
-        :param bits_per_attribute:
-            A dictionary of the bit positions for each attribute.
-        
         :param skip_empty: [optional]
-            Skip flags with no items assigned to them.        
-        """        
+            Skip flags with no items assigned to them.
+        """
+        totals = self._bit_totals()
         counts = {}
-        for attribute, bits in bits_per_attribute.items():
-            count = np.sum(self.are_any_bits_set(bits))
+        for key, bit in bit_per_key.items():
+            count = int(totals[bit]) if bit < totals.size else 0
             if count > 0 or not skip_empty:
-                counts[attribute] = count            
+                counts[key] = count
         return counts
+
+    def _bit_totals(self) -> np.ndarray:
+        """Return the number of items that have each bit set, for all `B * n_bits` bits of the data array."""
+        # Without unpacking to an (N, F) boolean temporary: count how often each byte value occurs in
+        # each column, then weight each byte value by the bits it has set.
+        array = self.array
+        if array.dtype != np.uint8:
+            array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")).view(np.uint8)
+        histograms = np.array([np.bincount(column, minlength=256) for column in array.T]).reshape((-1, 256))
+        return (histograms @ _BYTE_BITS).ravel()
+
+    def _column_masks(self, bits) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Group the given bit positions by the data array column that stores them.
+
+        Bits that lie beyond the current data array columns cannot be set, and are dropped.
+
+        :param bits:
+            The zero-indexed bit positions.
+
+        :returns:
+            A tuple of the unique data array columns, and the combined bit mask for each column.
+        """
+        return self._within_array(*self._group_bits(bits))
+
+    def _within_array(self, cols, masks) -> Tuple[np.ndarray, np.ndarray]:
+        """Drop the columns (and their masks) that lie beyond the current data array."""
+        keep = cols < self.array.shape[1]
+        return (cols[keep], masks[keep])
+
+    @classmethod
+    def _group_bits(cls, bits, n_bits: Optional[int] = None, dtype=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Group the given bit positions by the data array column that would store them.
+
+        :param bits:
+            The zero-indexed bit positions.
+
+        :param n_bits: [optional]
+            The number of bits per column, if not `n_bits`.
+
+        :param dtype: [optional]
+            The dtype of the columns, if not `dtype`.
+
+        :returns:
+            A tuple of the unique data array columns, and the combined bit mask for each column.
+        """
+        n_bits, dtype = (n_bits or cls.n_bits, dtype or cls.dtype)
+        num, offset = np.divmod(np.atleast_1d(np.asarray(bits, dtype=int)), n_bits)
+        cols, inverse = np.unique(num, return_inverse=True)
+        masks = np.zeros(cols.size, dtype=dtype)
+        np.bitwise_or.at(masks, inverse.ravel(), _bit_mask_table(n_bits, np.dtype(dtype))[offset])
+        return (cols, masks)
+
+    def _word_masks(self, bits) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Return the data array viewed as 64-bit words, and the word columns and masks for the given bits.
+
+        Viewing a uint8 data array as words (see `_words`) lets each AND cover 64 bits instead of
+        8. If the data array cannot be viewed this way, this returns `None`.
+
+        :param bits:
+            The zero-indexed bit positions.
+        """
+        words = self._words()
+        if words is None:
+            return None
+        # As for the data array itself, bits beyond its columns are dropped, even where the words
+        # (which can cover a few empty columns more) would hold them.
+        bits = np.ravel(bits)
+        bits = bits[bits < self.array.shape[1] * self.n_bits]
+        cols, masks = self._group_bits(bits, 64, np.dtype("<u8"))
+        keep = cols < words.shape[1]
+        return (words, cols[keep], masks[keep])
+
+    def _words(self) -> Optional[np.ndarray]:
+        """
+        Return a uint8 data array viewed as 64-bit words, or `None` if it cannot be viewed so.
+
+        A data array whose width is a multiple of 8 is viewed as is. Otherwise, if the data array
+        is the leading columns of the buffer that it was allocated in (see `_allocate`), then the
+        words cover those columns and the empty columns after them, up to a whole word.
+        """
+        if self.array.dtype != np.uint8:
+            return None
+        array = self.array
+        if array.shape[1] % 8:
+            buffer = getattr(self, "_buffer", None)
+            if (
+                buffer is None
+                or array.base is not buffer
+                or array.shape[0] != buffer.shape[0]
+                or array.__array_interface__["data"][0] != buffer.__array_interface__["data"][0]
+            ):
+                return None
+            array = buffer[:, :self._padded_width(array.shape[1])]
+        try:
+            return array.view("<u8")
+        except ValueError:
+            return None
+
+    def _allocate(self, N: int, B: int, capacity: int = 0) -> np.ndarray:
+        """
+        Set the data array to `N` items of `B` empty columns, as a view of a new buffer.
+
+        The buffer has at least `capacity` columns, and is padded to a whole number of 64-bit
+        words, so that the data array can be grown into it (see `_grow`) and viewed as words (see
+        `_words`). These extra columns are never part of the data array itself.
+
+        :param N:
+            The number of items.
+
+        :param B:
+            The number of data array columns.
+
+        :param capacity: [optional]
+            The minimum number of columns in the buffer.
+        """
+        buffer = np.zeros((N, self._padded_width(max(B, capacity))), dtype=self.dtype)
+        self.array = buffer[:, :B]
+        self._buffer = buffer
+        return buffer
+
+    def _padded_width(self, B: int) -> int:
+        """
+        Return the number of buffer columns to allocate for `B` columns of data.
+
+        For uint8 data arrays this rounds up to a whole number of 64-bit words, so that bulk bit
+        operations can use a uint64 view (see `_words`).
+
+        :param B:
+            The number of data array columns needed.
+        """
+        if self.dtype == np.uint8:
+            return -(-B // 8) * 8
+        return B
+
         
-    def as_boolean_array(self) -> np.ndarray:
+    def as_boolean_array(self, cache: bool = False) -> np.ndarray:
         """
         Return a (N, F) shaped big-endian boolean array indicating whether each bit is set for 
         each item, where the input data array has shape (N, B) and `F = B * n_bits` is the maximum
         possible number of flags.
+
+        :param cache: [optional]
+            Keep the (read-only) result, and return it from later calls with `cache=True` until
+            the flags are next changed with `set_bit`, `clear_bit`, or `toggle_bit`. Changes made
+            directly to `array` are not noticed, so only use this while the data array is left
+            alone.
         """
+        if cache:
+            cached = self._get_cache("_boolean")
+            if cached is not None:
+                return cached
         N, B = self.array.shape
-        num, offset = np.divmod(np.arange(B * self.n_bits), self.n_bits)
-        return (self.array[:, num] & (1 << offset)).astype(bool)
+        if self.array.dtype == np.uint8 and N * B > _kernels.NUMBA_THRESHOLD and _kernels.available():
+            # Same result as below, but spread over all cores.
+            flags = np.empty((N, B * 8), dtype=bool)
+            _kernels.unpack_bits(self.array, flags)
+        elif self.array.dtype == np.uint8:
+            flags = np.unpackbits(self.array, axis=1, bitorder="little").view(bool)
+        else:
+            # Wider dtypes: unpack the little-endian bytes of each element, which keeps bit order.
+            array = np.ascontiguousarray(self.array, dtype=self.array.dtype.newbyteorder("<"))
+            flags = np.unpackbits(array.view(np.uint8), axis=1, bitorder="little").view(bool)
+        if not cache:
+            return flags
+        flags.setflags(write=False)
+        return self._set_cache("_boolean", flags)
 
     def shrink(self):
         """Shrink the data array to the maximum required shape based on the highest bit set."""
-        index = 1 + np.where(np.any(self.array > 0, axis=0))[0][-1]
-        self.array = self.array[:, :index]
+        # The last used column is the first one with any bits set, counting from the end.
+        used = np.bitwise_or.reduce(self.array, axis=0)[::-1] != 0
+        index = used.size - int(np.argmax(used)) if used.any() else 0
+        self.array = np.ascontiguousarray(self.array[:, :index])
         return self
 
     def is_attribute_set(self, key, value) -> np.array:
@@ -198,11 +602,67 @@ class BaseFlags:
         :returns:
             A boolean array indicating whether the item has any flag with the given attribute.
         """
-        bits = self.get_bits_with_attribute(key, value)
-        if len(bits) == 0:
+        array, cols, masks = self._attribute_column_masks(key, value)
+        if cols.size == 0:
+            # None of these bits fit in the data array, so none can be set.
+            return np.zeros(len(self), dtype=bool)
+        if len(self) * cols.size > _kernels.NUMBA_THRESHOLD and _kernels.available():
+            # Fused AND and OR-reduce, without the (N, len(cols)) temporary.
+            return _kernels.any_masked(array, cols, masks)
+        return np.any(array[:, cols] & masks, axis=1)
+
+    def are_all_attributes_set(self, **attributes) -> np.array:
+        """
+        Return an N-length boolean array indicating whether the item has, for every given attribute,
+        any flag with that attribute. For example, `are_all_attributes_set(mapper="mwm", program="mwm_yso")`.
+
+        This is the same as combining `is_attribute_set` for each attribute with `&`, except that each
+        attribute after the first is only checked for the items that still match.
+
+        :param attributes:
+            The attribute keys and values.
+        """
+        # Look up every attribute first, so that an unknown one raises before any array work.
+        column_masks = [self._attribute_column_masks(key, value) for key, value in attributes.items()]
+        matched = np.ones(len(self), dtype=bool)
+        rows = None
+        for array, cols, masks in column_masks:
+            if rows is None:
+                matched = np.any(array[:, cols] & masks, axis=1)
+            else:
+                matched[rows] = np.any(array[np.ix_(rows, cols)] & masks, axis=1)
+            rows = np.flatnonzero(matched)
+            if rows.size == 0:
+                break
+        return matched
+
+    def _attribute_column_masks(self, key, value) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return the array to check, and the columns and combined masks for the bits with the given attribute.
+
+        There is one column (with a combined mask) per byte, or per 64-bit word where the data array
+        can be viewed that way, no matter how many bits live in that column. These are worked out once
+        per class, so there is no bit arithmetic here. Columns beyond the array are dropped.
+
+        :param key:
+            The attribute key.
+
+        :param value:
+            The attribute value.
+        """
+        words = self._words()
+        # An unknown attribute key raises KeyError, and an unknown value raises ValueError.
+        if words is None:
+            masks_by_value = self._attribute_masks[key]
+        else:
+            masks_by_value = self._attribute_word_masks[key]
+        try:
+            cols, masks = masks_by_value[value]
+        except KeyError:
             raise ValueError(f"No bits found with attribute {key}={value}")
-        num, offset = np.divmod(bits, self.n_bits)
-        return np.any(self.array[:, num] & (1 << offset), axis=1)
+        array = self.array if words is None else words
+        keep = cols < array.shape[1]
+        return (array, cols[keep], masks[keep])
     
     def get_bits_with_attribute(self, key, value) -> List[int]:
         """
@@ -217,14 +677,8 @@ class BaseFlags:
         :returns:
             A list of bit positions.
         """
-        bits = []
-        for bit, attrs in self.mapping.items():
-            try:
-                if attrs[key] == value:
-                    bits.append(bit)
-            except KeyError:
-                continue
-        return bits
+        # A copy, so that callers cannot change the index.
+        return list(self._attribute_index[key].get(value, ()))
     
     def are_any_bits_set(self, *bits) -> np.array:
         """
@@ -236,6 +690,19 @@ class BaseFlags:
         :returns:
             A boolean array indicating whether any of the given bits are set for each item.
         """
+        columnar = self._get_cache("_columnar")
+        if columnar is not None:
+            # OR together the packed item bitmaps of each bit, then unpack once.
+            N, B = self.array.shape
+            bits = np.ravel(bits).astype(int)
+            packed = np.bitwise_or.reduce(columnar[bits[bits < B * self.n_bits]], axis=0)
+            return np.unpackbits(packed, count=N, bitorder="little").view(bool)
+        if len(self) * np.size(bits) > _kernels.NUMBA_THRESHOLD and _kernels.available():
+            return _kernels.any_masked(self.array, *self._column_masks(np.ravel(bits)))
+        word_masks = self._word_masks(bits)
+        if word_masks is not None:
+            words, cols, masks = word_masks
+            return np.any(words[:, cols] & masks, axis=1)
         return np.any(self._check_bits(*bits), axis=1)
     
     def are_all_bits_set(self, *bits) -> np.array:
@@ -248,6 +715,12 @@ class BaseFlags:
         :returns:
             A boolean array indicating whether all of the given bits are set for each item.
         """
+        if len(self) * np.size(bits) > _kernels.NUMBA_THRESHOLD and _kernels.available():
+            return _kernels.all_masked(self.array, *self._column_masks(np.ravel(bits)))
+        word_masks = self._word_masks(bits)
+        if word_masks is not None:
+            words, cols, masks = word_masks
+            return np.all((words[:, cols] & masks) == masks, axis=1)
         return np.all(self._check_bits(*bits), axis=1)
 
     def is_bit_set(self, bit) -> np.array:
@@ -260,8 +733,30 @@ class BaseFlags:
         :returns:
             A boolean array indicating whether the given bit is set for each item.
         """        
+        if isinstance(bit, (int, np.integer)) and self._get_cache("_columnar") is None:
+            # A single bit lives in a single column, so there is nothing to gather or reduce.
+            num, offset = divmod(int(bit), self.n_bits)
+            if num >= self.array.shape[1]:
+                return np.zeros(len(self), dtype=bool)
+            return (self.array[:, num] & self.array.dtype.type(1 << offset)).astype(bool)
         return self.are_any_bits_set(bit)
 
+    def is_bit_set_row(self, index: int, bit: int) -> bool:
+        """
+        Return whether the given bit is set for a single item.
+
+        This is meant for scalar use (e.g., checking one item at a time), where it avoids the
+        NumPy overhead of `is_bit_set`. For many items, use `is_bit_set` instead.
+
+        :param index:
+            The item index.
+
+        :param bit:
+            The zero-indexed bit position to check.
+        """
+        row = self.array[index].astype(self.array.dtype.newbyteorder("<"), copy=False).tobytes()
+        return bool((int.from_bytes(row, "little") >> bit) & 1)
+
     def set_bit(self, index, bit):
         """
         Set the given bit for the given item.
@@ -272,8 +767,38 @@ class BaseFlags:
         :param bit:
             The zero-indexed bit position to set.
         """        
-        num, offset = self._ensure_shape_for_bit(bit)        
-        self.array[index, num] |= (1 << offset)
+        self._clear_caches()
+        num, offset = self._ensure_shape_for_bit(bit)
+        if isinstance(num, int):
+            self.array[index, num] |= self.array.dtype.type(1 << offset)
+            return self
+        # bitwise_or.at so that bits sharing a column are all set.
+        np.bitwise_or.at(self.array, (index, num), self._bit_lut[offset])
+        return self
+
+    def set_bits(self, indices, bits):
+        """
+        Set many bits at once, where the `i`-th bit in `bits` is set for the `i`-th item in `indices`.
+
+        This is equivalent to calling `set_bit` for each pair, but is much faster when building large
+        flag arrays.
+
+        :param indices:
+            An array of item indices.
+
+        :param bits:
+            An array of zero-indexed bit positions to set, of the same length as `indices`.
+        """
+        indices, bits = np.broadcast_arrays(np.asarray(indices, dtype=np.intp), np.asarray(bits, dtype=np.intp))
+        self._clear_caches()
+        if bits.size == 0:
+            return self
+        if np.min(bits) < 0:
+            raise ValueError("Bit positions must be non-negative.")
+        num, offset = np.divmod(bits, self.n_bits)
+        self._grow(int(np.max(num)) + 1)
+        # bitwise_or.at so that repeated (index, column) pairs are all applied.
+        np.bitwise_or.at(self.array, (indices, num), self._bit_lut[offset])
         return self
 
     def clear_bit(self, index, bit):
@@ -286,12 +811,20 @@ class BaseFlags:
         :param bit:
             The zero-indexed bit position to clear.
         """
+        self._clear_caches()
         # Here we don't ensure_shape_for_bit because we don't want to create a YUGE array just
         # to clear a ficticious bit at position 2**128
-        num, offset = np.divmod(bit, self.n_bits)
-        N, B = self.array.shape
-        is_set_able = B > num
-        self.array[index, num[is_set_able]] &= ~(1 << offset[is_set_able])
+        if isinstance(bit, (int, np.integer)):
+            num, offset = divmod(int(bit), self.n_bits)
+            if num < self.array.shape[1]:
+                self.array[index, num] &= ~self.array.dtype.type(1 << offset)
+            return self
+        num, offset = np.divmod(np.atleast_1d(bit), self.n_bits)
+        is_set_able = num < self.array.shape[1]
+        # Take the masks in the data array dtype so the inversion does not widen it, and use
+        # bitwise_and.at so that bits sharing a column are all cleared.
+        masks = self._bit_lut[offset[is_set_able]]
+        np.bitwise_and.at(self.array, (index, num[is_set_able]), ~masks)
         return self
     
     def toggle_bit(self, index, bit):
@@ -304,16 +837,64 @@ class BaseFlags:
         :param bit:
             The zero-indexed bit position to clear.
         """
+        self._clear_caches()
         num, offset = self._ensure_shape_for_bit(bit)
-        self.array[index, num] ^= (1 << offset)
+        if isinstance(num, int):
+            self.array[index, num] ^= self.array.dtype.type(1 << offset)
+            return self
+        np.bitwise_xor.at(self.array, (index, num), self._bit_lut[offset])
         return self
         
+    def to_columnar(self) -> np.ndarray:
+        """
+        Return a (F, ceil(N / 8)) shaped array that stores, for each bit, a packed bitmap of the items
+        that have that bit set.
+
+        The result is cached until the flags are next changed with `set_bit`, `clear_bit`, or
+        `toggle_bit`. While it is cached, `are_any_bits_set` and `is_bit_set` are answered from it,
+        which reads far less memory when a query touches few bits across many items.
+        """
+        columnar = self._get_cache("_columnar")
+        if columnar is None:
+            columnar = self._set_cache("_columnar", np.packbits(self.as_boolean_array().T, axis=1, bitorder="little"))
+        return columnar
+
+    def _clear_caches(self) -> None:
+        """
+        Drop anything cached from the data array, because it is about to change.
+
+        This also bumps the version shared with any flags that view the same data (see `__getitem__`),
+        so that their caches are dropped too.
+        """
+        self._columnar = None
+        self._boolean = None
+        self._shared_version()[0] += 1
+
+    def _shared_version(self) -> List[int]:
+        """Return the (mutable) version of the data array, which is shared with views of it."""
+        version = getattr(self, "_version", None)
+        if version is None:
+            version = self._version = [0]
+        return version
+
+    def _get_cache(self, name: str):
+        """Return what is cached under `name`, or `None` if nothing is, or the data has changed since."""
+        cached = getattr(self, name, None)
+        if cached is not None and cached[0] is self.array and cached[1] == self._shared_version()[0]:
+            return cached[2]
+        return None
+
+    def _set_cache(self, name: str, value):
+        """Cache `value` under `name` for the current data array and version, and return it."""
+        setattr(self, name, (self.array, self._shared_version()[0], value))
+        return value
+
     def _check_bits(self, *bits):
         """Check whether the given bits are set or not."""
         num, offset = np.divmod(bits, self.n_bits)
         N, B = self.array.shape
         can_be_set = B > num
-        return self.array[:, num[can_be_set]] & (1 << offset[can_be_set])
+        return self.array[:, num[can_be_set]] & self._bit_lut[offset[can_be_set]]
 
     def _ensure_shape_for_bit(self, bit: int) -> Tuple[int, int]:
         """
@@ -323,26 +904,85 @@ class BaseFlags:
             The zero-indexed bit position to check.
         
         :returns:
-            A tuple of the number of the data array column and the bit offset within that column.
+            A tuple of the number of the data array column and the bit offset within that column. These
+            are Python integers if `bit` is a single integer.
         """
+        if isinstance(bit, (int, np.integer)):
+            # Stay in Python integers: this is called once per bit when building flags item by item.
+            num, offset = divmod(int(bit), self.n_bits)
+            if num >= self.array.shape[1]:
+                self._grow(num + 1)
+            return (num, offset)
         num, offset = np.divmod(bit, self.n_bits)
-        N, F = self.array.shape
-        if F <= np.max(num):
-            C = (np.max(num) + 1) - F
-            # little-endian
-            self.array = np.hstack([
-                self.array,
-                np.zeros((N, C), dtype=self.array.dtype)
-            ])
+        self._grow(np.max(num) + 1)
         return (num, offset)
 
+    def _grow(self, B: int) -> None:
+        """
+        Pad the data array with empty columns so that it has at least `B` columns.
+
+        :param B:
+            The minimum number of data array columns required.
+        """
+        N, F = self.array.shape
+        if F >= B:
+            return None
+        # Grow geometrically into a wider buffer, and hand out a view of the first `B` columns so
+        # that repeated growth does not copy the data array every time. If the data array is no
+        # longer a view of the buffer (e.g., it was replaced, or these flags were copied), then we
+        # start a new one.
+        buffer = getattr(self, "_buffer", None)
+        if buffer is None or self.array.base is not buffer or buffer.shape[1] < B:
+            array = self.array
+            self._allocate(N, B, 2 * F)[:, :F] = array
+        else:
+            self.array = buffer[:, :B]
+        return None
+
     def __repr__(self):
         N, B = self.array.shape
         return f"<{self.__class__.__name__} with {N:,} items and up to {B * self.n_bits:,} flags ({len(self.mapping):,} defined) at {hex(id(self))}>"
 
+    def __getstate__(self):
+        # Only the data array: the caches and the growth buffer are rebuilt as needed.
+        return {"array": self.array}
+
+    def __setstate__(self, state):
+        self.array = state["array"]
+
     def __len__(self):
         N, B = self.array.shape
         return N
+
+    def __getitem__(self, index):
+        """
+        Return the flags for the given item(s).
+
+        An integer or a slice returns a view of the data array, so changes to it are shared with these
+        flags. A boolean mask or a list of indices returns a copy. Indices that select anything
+        other than whole items (e.g., a tuple that also selects columns) are not supported.
+        """
+        if isinstance(index, tuple):
+            raise TypeError(
+                "Flags can only be indexed by item, with an integer, slice, boolean mask, or list "
+                "of indices."
+            )
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if not -len(self) <= index < len(self):
+                raise IndexError(f"index {index} is out of bounds for {len(self)} items")
+            # A basic slice rather than `[[index]]`, so that we get a view and not a copy.
+            index = slice(index, (index + 1) or None)
+        # Skip __init__: the data array is already in the right dtype and shape.
+        array = self.array[index]
+        if array.ndim != 2:
+            raise IndexError(f"index must select items, but gave an array of shape {array.shape}")
+        item = self.__class__.__new__(self.__class__)
+        item.array = array
+        # Integers and slices give views, so a change made through either one must drop the caches of
+        # both. Sharing the version does that (and for a copy it only costs the odd extra recompute).
+        item._version = self._shared_version()
+        return item
     
     
     
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Optional compiled kernels for hot paths.
+
+These need `numba`, which is only imported (and the kernels only compiled) the first time a caller
+checks `available()`. Callers do that only once the work is above `NUMBA_THRESHOLD`, so importing
+`sdss_semaphore` never pays for importing numba.
+"""
+
+import numpy as np
+
+# Only dispatch to the kernels when the (items x columns) work is large enough to pay for it.
+NUMBA_THRESHOLD = 1_000_000
+
+# Replaced with `numba.prange` before the kernels are compiled.
+prange = range
+
+# The compiled kernels by name, or an empty dictionary if numba is not installed.
+_compiled = None
+
+
+def available() -> bool:
+    """
+    Return whether the compiled kernels can be used, importing numba and compiling them if needed.
+    """
+    global _compiled, prange
+    if _compiled is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _compiled = {}
+        else:
+            jit = njit(parallel=True, cache=True)
+            _compiled = {
+                "any_masked": jit(_any_masked),
+                "all_masked": jit(_all_masked),
+                "unpack_bits": jit(_unpack_bits),
+            }
+    return bool(_compiled)
+
+
+def any_masked(array, cols, masks):
+    """Return whether any masked bit is set in the given columns, for each row of `array`."""
+    return _compiled["any_masked"](array, cols, masks)
+
+
+def all_masked(array, cols, masks):
+    """Return whether every masked bit is set in the given columns, for each row of `array`."""
+    return _compiled["all_masked"](array, cols, masks)
+
+
+def unpack_bits(array, out):
+    """
+    Unpack each byte of a uint8 `array` into 8 little-endian booleans in `out`, in parallel over
+    rows.
+    """
+    return _compiled["unpack_bits"](array, out)
+
+
+def _any_masked(array, cols, masks):
+    N = array.shape[0]
+    out = np.zeros(N, dtype=np.bool_)
+    for i in prange(N):
+        acc = 0
+        for j in range(cols.size):
+            acc |= array[i, cols[j]] & masks[j]
+        out[i] = acc != 0
+    return out
+
+
+def _all_masked(array, cols, masks):
+    N = array.shape[0]
+    out = np.ones(N, dtype=np.bool_)
+    for i in prange(N):
+        for j in range(cols.size):
+            if (array[i, cols[j]] & masks[j]) != masks[j]:
+                out[i] = False
+                break
+    return out
+
+
+def _unpack_bits(array, out):
+    N, B = array.shape
+    for i in prange(N):
+        for j in range(B):
+            byte = array[i, j]
+            for k in range(8):
+                out[i, j * 8 + k] = (byte >> k) & 1
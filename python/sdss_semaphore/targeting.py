@@ -7,6 +7,8 @@ class BaseTargetingFlags(BaseFlags):
 
     """A base class for communicating SDSS-V targeting information with flags."""
 
+    __slots__ = ()
+
     @property
     def all_mappers(self) -> Tuple[str]:
         """Return a tuple of all mappers."""
@@ -48,7 +50,12 @@ class BaseTargetingFlags(BaseFlags):
         :param carton_pk:
             The carton primary key.            
         """
-        return self.is_attribute_set("carton_pk", carton_pk)
+        # Primary keys are unique, so this is a single bit.
+        try:
+            bit = self.bit_position_from_carton_pk[carton_pk]
+        except KeyError:
+            raise ValueError(f"No bits found with attribute carton_pk={carton_pk}")
+        return self.is_bit_set(bit)
 
     def in_carton_name(self, name: str) -> np.array:
         """
@@ -105,10 +112,7 @@ class BaseTargetingFlags(BaseFlags):
         :returns:
             A dictionary with carton labels as keys and item counts as values.
         """
-        return self._count(
-            { attrs["label"]: [bit] for bit, attrs in self.mapping.items() }, 
-            skip_empty=skip_empty
-        )
+        return self._count_bits(self._bit_position_from_label, skip_empty=skip_empty)
 
     def set_bit_by_carton_pk(self, index: int, carton_pk: int):
         """
@@ -123,6 +127,61 @@ class BaseTargetingFlags(BaseFlags):
         bit = self.bit_position_from_carton_pk[carton_pk]
         return self.set_bit(index, bit)
 
+    def set_bits_by_carton_pk(self, indices, carton_pks):
+        """
+        Set the bits for many (item, carton) pairs at once.
+
+        :param indices:
+            An array of item indices.
+
+        :param carton_pks:
+            An array of carton primary keys, of the same length as `indices`.
+        """
+        return self.set_bits(indices, self.bit_positions_from_carton_pks(carton_pks))
+
+    def bit_positions_from_carton_pks(self, carton_pks) -> np.ndarray:
+        """
+        Return the bit positions for many carton primary keys at once.
+
+        :param carton_pks:
+            An array of carton primary keys.
+
+        :raises TypeError:
+            If the carton primary keys are not integers.
+
+        :raises KeyError:
+            If any carton primary key is unknown.
+        """
+        carton_pks = np.asarray(carton_pks)
+        # Casting would truncate, e.g., 126.5 to 126, and so find the wrong carton.
+        if carton_pks.size > 0 and not np.issubdtype(carton_pks.dtype, np.integer):
+            raise TypeError(f"Carton primary keys must be integers, not {carton_pks.dtype}")
+        carton_pks = carton_pks.astype(np.intp, copy=False)
+        lookup = self._bit_position_from_carton_pk_array
+        is_known = (carton_pks >= 0) & (carton_pks < lookup.size)
+        bits = np.where(is_known, lookup[np.where(is_known, carton_pks, 0)], -1)
+        if np.any(bits < 0):
+            unknown = np.unique(carton_pks[bits < 0]).tolist()
+            raise KeyError(f"Unknown carton primary key(s): {unknown}")
+        return bits
+
+    @cached_class_property
+    def _bit_position_from_carton_pk_array(self) -> np.ndarray:
+        """
+        An array indexed by carton primary key that gives the bit position, or -1 if there is no
+        such carton.
+        """
+        carton_pks = np.fromiter(self.bit_position_from_carton_pk.keys(), dtype=np.intp)
+        bits = np.fromiter(self.bit_position_from_carton_pk.values(), dtype=np.intp)
+        lookup = np.full(carton_pks.max(initial=-1) + 1, -1, dtype=np.intp)
+        lookup[carton_pks] = bits
+        return lookup
+
+    @cached_class_property
+    def _bit_position_from_label(self) -> dict:
+        """A dictionary with carton labels as keys, and bit positions as values."""
+        return { attrs["label"]: bit for bit, attrs in self.mapping.items() }
+
     @cached_class_property
     def bit_position_from_carton_pk(self):
         """
@@ -136,6 +195,8 @@ class TargetingFlags(BaseTargetingFlags):
 
     """Communicating with SDSS-V targeting flags."""
 
+    __slots__ = ()
+
     dtype, n_bits = (np.uint8, 8)
     MAPPING_BASENAME = "sdss5_target_1_with_groups.csv"
 
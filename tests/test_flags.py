@@ -1,8 +1,14 @@
 # encoding: utf-8
 #
 # main.py
+import os
+import pickle
+import shutil
+import stat
+import sys
+from copy import deepcopy
 import numpy as np
-from pytest import mark
+from pytest import fixture, importorskip, mark, raises, warns
 
 '''
 from semaphore.flags import Flags
@@ -74,3 +80,409 @@ class TestFlags(object):
         g.__repr__()
 
 ''' 
+
+
+import sdss_semaphore
+from sdss_semaphore import BaseFlags, cached_class_property
+from sdss_semaphore.targeting import TargetingFlags
+
+
+class Flags(BaseFlags):
+    dtype, n_bits = (np.uint8, 8)
+    mapping = {}
+
+
+class TestClearBit(object):
+
+    def test_clear_scalar_bit(self):
+        flags = Flags(np.full((2, 2), 255, dtype=np.uint8))
+        flags.clear_bit(0, 9)
+        assert flags.array.dtype == np.uint8
+        assert flags.array.tolist() == [[255, 253], [255, 255]]
+
+    def test_clear_bits_in_same_column(self):
+        flags = Flags(np.full((2, 2), 255, dtype=np.uint8))
+        flags.clear_bit(1, [1, 2, 3])
+        assert flags.array.tolist() == [[255, 255], [241, 255]]
+
+    def test_clear_bit_beyond_array(self):
+        flags = Flags(np.full((1, 1), 255, dtype=np.uint8))
+        flags.clear_bit(0, [0, 1000])
+        assert flags.array.shape == (1, 1)
+        assert flags.array.tolist() == [[254]]
+
+
+class WideFlags(BaseFlags):
+    dtype, n_bits = (np.uint16, 16)
+    mapping = {}
+
+
+class TestBooleanArray(object):
+
+    @mark.parametrize(('klass', ), [(Flags, ), (WideFlags, )])
+    def test_bit_order(self, klass):
+        array = np.random.randint(0, 2**klass.n_bits, size=(10, 3)).astype(klass.dtype)
+        num, offset = np.divmod(np.arange(3 * klass.n_bits), klass.n_bits)
+        expected = (array[:, num] & (1 << offset)).astype(bool)
+        assert np.array_equal(klass(array).as_boolean_array(), expected)
+
+    def test_cache_is_opt_in(self):
+        array = np.zeros((2, 1), dtype=np.uint8)
+        flags = Flags(array)
+        cached = flags.as_boolean_array(cache=True)
+        assert flags.as_boolean_array(cache=True) is cached
+        # A change made directly to the data array is seen by everything that does not opt in.
+        array[0, 0] = 2
+        assert flags.as_boolean_array()[0].tolist() == [False, True] + [False] * 6
+        assert flags._bit_totals().tolist() == [0, 1] + [0] * 6
+        assert list(flags.bits_set) == [(1, ), ()]
+
+
+class TestPickle(object):
+
+    def test_pickle_keeps_only_data_array(self):
+        flags = Flags(np.random.randint(0, 256, size=(1000, 8)).astype(np.uint8))
+        flags.set_bit(0, 100)
+        flags.as_boolean_array(cache=True)
+        flags.to_columnar()
+        data = pickle.dumps(flags)
+        assert len(data) < 2 * flags.array.nbytes
+        copied = pickle.loads(data)
+        assert np.array_equal(copied.array, flags.array)
+        assert list(copied.bits_set) == list(flags.bits_set)
+
+
+class TestConstructors(object):
+
+    def test_from_hex_strings(self):
+        flags = Flags(["0102", "", "03", "040506"])
+        expected = Flags([
+            bytearray(b"\x01\x02"), bytearray(), bytearray(b"\x03"), bytearray(b"\x04\x05\x06")
+        ])
+        assert np.array_equal(flags.array, expected.array)
+        assert flags.array[:, :3].tolist() == [[1, 2, 0], [0, 0, 0], [3, 0, 0], [4, 5, 6]]
+
+    def test_from_bytearrays_wide_dtype(self):
+        with warns(UserWarning):
+            flags = WideFlags([bytearray(b"\x01\x02\x03\x04"), bytearray(b"\x05\x06")])
+        # Each pair of bytes is one (native byte order) uint16 element, as np.frombuffer reads
+        # them.
+        assert flags.array.tolist() == [
+            np.frombuffer(b"\x01\x02\x03\x04", dtype=np.uint16).tolist(),
+            np.frombuffer(b"\x05\x06\x00\x00", dtype=np.uint16).tolist(),
+        ]
+
+    def test_array_is_used_as_is(self):
+        array = np.zeros((2, 1), dtype=np.uint8)
+        Flags(array).set_bit(1, 2)
+        assert array.tolist() == [[0], [4]]
+
+    def test_read_only_array_is_copied(self):
+        array = np.frombuffer(b"\x01\x00", dtype=np.uint8).reshape((2, 1))
+        flags = Flags(array)
+        flags.set_bit(1, 2)
+        assert flags.array.tolist() == [[1], [4]]
+        assert array.tolist() == [[1], [0]]
+
+    def test_from_sparse_bits(self):
+        flags = Flags.from_sparse_bits(4, [0, 2, 2, 0], [3, 70, 1, 3])
+        assert len(flags) == 4
+        assert list(flags.bits_set) == [(3, ), (), (1, 70), ()]
+
+
+class TestGetItem(object):
+
+    @mark.parametrize(('index', ), [(0, ), (2, ), (-1, ), (-3, )])
+    def test_item_is_view(self, index):
+        flags = Flags(np.arange(9, dtype=np.uint8).reshape((3, 3)))
+        item = flags[index]
+        assert isinstance(item, Flags)
+        assert item.array.tolist() == [flags.array[index].tolist()]
+        assert np.shares_memory(item.array, flags.array)
+
+    def test_change_through_item_drops_caches(self):
+        flags = Flags(np.zeros((3, 8), dtype=np.uint8))
+        flags.as_boolean_array(cache=True)
+        flags.to_columnar()
+        flags[1].set_bit(0, 3)
+        assert np.flatnonzero(flags.as_boolean_array(cache=True)[1]).tolist() == [3]
+        assert flags.is_bit_set(3).tolist() == [False, True, False]
+        assert flags.are_any_bits_set(3).tolist() == [False, True, False]
+
+    def test_change_to_parent_drops_item_caches(self):
+        flags = Flags(np.zeros((3, 8), dtype=np.uint8))
+        item = flags[0]
+        item.as_boolean_array(cache=True)
+        flags.set_bit(0, 7)
+        assert np.flatnonzero(item.as_boolean_array(cache=True)).tolist() == [7]
+
+    def test_item_out_of_bounds(self):
+        with raises(IndexError):
+            Flags(np.zeros((3, 1), dtype=np.uint8))[3]
+
+    def test_tuple_index(self):
+        with raises(TypeError):
+            Flags(np.zeros((3, 2), dtype=np.uint8))[0, 1]
+
+    @mark.parametrize(('index', ), [(None, ), (np.zeros((3, 2), dtype=bool), )])
+    def test_index_not_selecting_items(self, index):
+        with raises(IndexError):
+            Flags(np.zeros((3, 2), dtype=np.uint8))[index]
+
+    def test_mask_and_list_index(self):
+        flags = Flags(np.arange(6, dtype=np.uint8).reshape((3, 2)))
+        assert flags[np.array([True, False, True])].array.tolist() == [[0, 1], [4, 5]]
+        assert len(flags[[2, 0]]) == 2
+
+
+class TestSetBits(object):
+
+    def test_set_bits_matches_set_bit(self):
+        indices = np.random.randint(0, 20, size=500)
+        bits = np.random.randint(0, 100, size=500)
+        expected = Flags(np.zeros((20, 0), dtype=np.uint8))
+        for index, bit in zip(indices, bits):
+            expected.set_bit(int(index), int(bit))
+        flags = Flags(np.zeros((20, 0), dtype=np.uint8)).set_bits(indices, bits)
+        assert list(flags.bits_set) == list(expected.bits_set)
+
+    def test_set_bit_list_in_same_column(self):
+        flags = Flags(np.zeros((2, 1), dtype=np.uint8))
+        flags.set_bit(1, [1, 2, 20])
+        assert flags.array.dtype == np.uint8
+        assert list(flags.bits_set) == [(), (1, 2, 20)]
+
+    def test_width_is_not_padded(self):
+        assert Flags().set_bit(0, 3).array.shape == (1, 1)
+        assert Flags([bytearray(b"\x01\x02\x03")]).array.shape == (1, 3)
+        flags = Flags([Flags(np.ones((1, 2), dtype=np.uint8)), Flags()])
+        assert flags.array.tolist() == [[1, 1], [0, 0]]
+
+    def test_words_match_bytes(self):
+        flags = Flags(np.zeros((3, 0), dtype=np.uint8)).set_bits([0, 1, 1, 2], [0, 0, 17, 17])
+        # The data array is 3 columns of a padded buffer, so it is checked as 64-bit words.
+        assert flags.array.shape == (3, 3)
+        assert flags._words() is not None
+        copied = Flags(flags.array.copy())
+        assert copied._words() is None
+        for bits in ([0], [17], [0, 17], [0, 30], [30]):
+            assert np.array_equal(flags.are_all_bits_set(*bits), copied.are_all_bits_set(*bits))
+            assert np.array_equal(flags.are_any_bits_set(*bits), copied.are_any_bits_set(*bits))
+        assert flags.popcount_per_item().tolist() == [1, 2, 1]
+
+    @mark.parametrize(('copy', ), [(deepcopy, ), (lambda f: pickle.loads(pickle.dumps(f)), )])
+    def test_grow_after_copy(self, copy):
+        flags = Flags(np.zeros((1, 13), dtype=np.uint8))
+        flags.set_bit(0, 104)
+        copied = copy(flags)
+        copied.set_bit(0, 0)
+        copied.set_bit(0, 136)
+        assert list(copied.bits_set) == [(0, 104, 136)]
+        assert list(flags.bits_set) == [(104, )]
+
+
+class TestPopcount(object):
+
+    @mark.parametrize(('klass', 'B'), [(Flags, 8), (Flags, 3), (WideFlags, 2)])
+    def test_popcount_per_item(self, klass, B):
+        flags = klass(np.random.randint(0, 2**klass.n_bits, size=(10, B)).astype(klass.dtype))
+        assert np.array_equal(flags.popcount_per_item(), flags.as_boolean_array().sum(axis=1))
+
+
+class TestAttributes(object):
+
+    @mark.parametrize(('key', ), [('mapper', ), ('program', ), ('alt_program', ), ('carton_pk', )])
+    @mark.parametrize(('B', ), [(60, ), (64, )])
+    def test_is_attribute_set(self, key, B):
+        flags = TargetingFlags(np.random.randint(0, 256, size=(50, B)).astype(np.uint8))
+        for value in set(attrs[key] for attrs in flags.mapping.values()):
+            bits = [bit for bit, attrs in flags.mapping.items() if attrs[key] == value]
+            expected = np.any(flags.as_boolean_array()[:, bits], axis=1)
+            assert np.array_equal(flags.is_attribute_set(key, value), expected)
+
+    def test_are_all_attributes_set(self):
+        flags = TargetingFlags((np.random.randint(0, 256, size=(50, 64)) // 15).astype(np.uint8))
+        for mapper in flags.all_mappers:
+            for program in flags.all_programs:
+                expected = flags.in_mapper(mapper) & flags.in_program(program)
+                assert np.array_equal(
+                    flags.are_all_attributes_set(mapper=mapper, program=program), expected
+                )
+
+    @mark.parametrize(('B', ), [(3, ), (64, )])
+    def test_unknown_attribute(self, B):
+        flags = TargetingFlags(np.zeros((2, B), dtype=np.uint8))
+        for query in (
+            lambda: flags.is_attribute_set("mapperr", "mwm"),
+            lambda: flags.are_all_attributes_set(mapperr="mwm"),
+            lambda: flags.get_bits_with_attribute("mapperr", "mwm"),
+            lambda: flags.count_by_attribute("mapperr"),
+            lambda: flags._all_attributes("mapperr"),
+        ):
+            with raises(KeyError):
+                query()
+        with raises(ValueError):
+            flags.in_mapper("no such mapper")
+        assert flags.get_bits_with_attribute("mapper", "no such mapper") == []
+
+    def test_bit_positions_from_carton_pks(self):
+        carton_pks = list(TargetingFlags.bit_position_from_carton_pk)[:3]
+        expected = [TargetingFlags.bit_position_from_carton_pk[pk] for pk in carton_pks]
+        assert TargetingFlags().bit_positions_from_carton_pks(carton_pks).tolist() == expected
+        assert TargetingFlags().bit_positions_from_carton_pks([]).tolist() == []
+        with raises(KeyError):
+            TargetingFlags().bit_positions_from_carton_pks([carton_pks[0], -1])
+        with raises(TypeError):
+            TargetingFlags().bit_positions_from_carton_pks([carton_pks[0] + 0.5])
+
+    @mark.parametrize(('B', ), [(60, ), (64, )])
+    def test_count_by_attribute(self, B):
+        flags = TargetingFlags((np.random.randint(0, 256, size=(50, B)) // 63).astype(np.uint8))
+        counts = flags.count_by_attribute("program")
+        assert list(counts) == list(flags.all_programs)
+        for program, count in counts.items():
+            assert count == np.count_nonzero(flags.in_program(program))
+
+
+@fixture
+def mapping_path(tmp_path):
+    """A copy of the targeting mapping CSV in a temporary directory, where its cache is written."""
+    etc = os.path.join(os.path.dirname(sdss_semaphore.__file__), "etc")
+    return str(shutil.copy(os.path.join(etc, TargetingFlags.MAPPING_BASENAME), tmp_path))
+
+
+class TestReadMapping(object):
+
+    @staticmethod
+    def read_with(monkeypatch, path, reader):
+        """Read the mapping with `reader`, by making the readers tried before it unimportable."""
+        importorskip(reader)
+        readers = ["pyarrow", "pandas", "astropy"]
+        with monkeypatch.context() as patch:
+            for name in readers[:readers.index(reader)]:
+                patch.setitem(sys.modules, name, None)
+            return sdss_semaphore._read_mapping(path)
+
+    @mark.parametrize(('reader', ), [('pyarrow', ), ('pandas', ), ('astropy', )])
+    def test_reader(self, monkeypatch, tmp_path, mapping_path, reader):
+        mapping = self.read_with(monkeypatch, mapping_path, reader)
+        # Compare against the astropy reader, with its own copy of the CSV (and so its own cache).
+        astropy_path = str(shutil.copy(mapping_path, tmp_path / "astropy.csv"))
+        assert mapping == self.read_with(monkeypatch, astropy_path, "astropy")
+        assert mapping == dict(TargetingFlags.mapping)
+        for row in mapping.values():
+            for value in (*row.keys(), *row.values()):
+                if isinstance(value, str):
+                    assert type(value) is str and value is sys.intern(value)
+
+    @mark.parametrize(('contents', ), [(b"not a pickle", ), (b"", ), (pickle.dumps([1, 2, 3]), )])
+    def test_bad_cache(self, mapping_path, contents):
+        with open(f"{mapping_path}.pkl", "wb") as fp:
+            fp.write(contents)
+        assert sdss_semaphore._read_mapping(mapping_path) == dict(TargetingFlags.mapping)
+        # The bad cache is replaced with a good one.
+        with open(f"{mapping_path}.pkl", "rb") as fp:
+            assert pickle.load(fp)[1] == dict(TargetingFlags.mapping)
+
+    @mark.parametrize(('version', 'size_change'), [(0, 1), (0, 0), (-1, 0)])
+    def test_stale_cache(self, mapping_path, version, size_change):
+        source = os.stat(mapping_path)
+        key = (
+            sdss_semaphore._MAPPING_CACHE_VERSION + version,
+            source.st_size + size_change,
+            source.st_mtime,
+        )
+        # A cache left behind by another version of the CSV (or of this package), even one that is
+        # newer than the CSV.
+        with open(f"{mapping_path}.pkl", "wb") as fp:
+            pickle.dump((key, {0: {"bit": 0}}), fp)
+        os.utime(f"{mapping_path}.pkl", (source.st_mtime + 10, source.st_mtime + 10))
+        expected = {0: {"bit": 0}} if version == size_change == 0 else dict(TargetingFlags.mapping)
+        assert sdss_semaphore._read_mapping(mapping_path) == expected
+
+    def test_cache_is_readable_by_others(self, mapping_path):
+        sdss_semaphore._read_mapping(mapping_path)
+        assert stat.S_IMODE(os.stat(f"{mapping_path}.pkl").st_mode) == 0o644
+
+
+class TestCachedClassProperty(object):
+
+    def test_subclass_computes_own_value(self):
+
+        class Parent(object):
+            @cached_class_property
+            def who(cls):
+                return cls.__name__
+
+        assert Parent.who == "Parent"
+
+        class Child(Parent):
+            pass
+
+        assert Child.who == "Child"
+        assert Parent.who == "Parent"
+
+    def test_flags_subclass_computes_own_value(self):
+
+        class Parent(Flags):
+            @cached_class_property
+            def who(cls):
+                return cls.__name__
+
+        assert Parent.who == "Parent"
+
+        class Child(Parent):
+            pass
+
+        class Override(Child):
+            who = "fixed"
+
+        assert Child.who == "Child"
+        assert Override.who == "fixed"
+
+    def test_subclass_defined_before_parent_is_read(self):
+
+        class Parent(object):
+            @cached_class_property
+            def who(cls):
+                return cls.__name__
+
+        class Child(Parent):
+            pass
+
+        assert Parent.who == "Parent"
+        assert Child.who == "Child"
+
+    def test_targeting_subclass_has_own_mapping(self):
+
+        class Other(TargetingFlags):
+            MAPPING_BASENAME = "other.csv"
+
+        assert TargetingFlags.mapping is TargetingFlags.mapping
+        with raises(FileNotFoundError):
+            Other.mapping
+
+
+class TestKernels(object):
+
+    @mark.parametrize(('B', ), [(3, ), (8, )])
+    def test_kernels_match_numpy(self, monkeypatch, B):
+        from sdss_semaphore import _kernels
+        importorskip("numba")
+        array = np.random.randint(0, 256, size=(100, B)).astype(np.uint8)
+        bits = [0, 3, 9, 17, 500]
+
+        def results():
+            flags = TargetingFlags(array)
+            return (
+                flags.as_boolean_array(),
+                flags.are_any_bits_set(*bits),
+                flags.are_all_bits_set(*bits[:3]),
+                flags.in_mapper("mwm"),
+            )
+
+        monkeypatch.setattr(_kernels, "NUMBA_THRESHOLD", 10**12)
+        expected = results()
+        monkeypatch.setattr(_kernels, "NUMBA_THRESHOLD", 0)
+        for result, expect in zip(results(), expected):
+            assert np.array_equal(result, expect)